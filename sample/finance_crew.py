@@ -10,6 +10,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Verbose agents print every step to stdout; opt in with CREW_VERBOSE=true
+VERBOSE = os.getenv("CREW_VERBOSE", "false").lower() in ("1", "true", "yes")
+
 class QueryAnalysisOutput(BaseModel):
     """Structured output for the query analysis task."""
     symbols: list[str] = Field(..., description="List of stock ticker symbols (e.g., ['TSLA', 'AAPL']).")
@@ -33,7 +36,7 @@ query_parser_agent = Agent(
     goal="Extract stock details and fetch required data from this user query: {query}.",
     backstory="You are a financial analyst specializing in stock market data retrieval.",
     llm=llm,
-    verbose=True,
+    verbose=VERBOSE,
     memory=True,
 )
 
@@ -53,7 +56,7 @@ code_writer_agent = Agent(
                  You are also a Pandas, Matplotlib and yfinance library expert.
                  You are skilled at writing production-ready Python code""",
     llm=llm,
-    verbose=True,
+    verbose=VERBOSE,
 )
 
 code_writer_task = Task(
@@ -75,7 +78,7 @@ code_execution_agent = Agent(
     allow_code_execution=True,   # This automatically adds the CodeInterpreterTool
     allow_delegation=True,
     llm=llm,
-    verbose=True,
+    verbose=VERBOSE,
 )
 
 code_execution_task = Task(
@@ -96,6 +99,13 @@ def run_financial_analysis(query):
     result = crew.kickoff(inputs={"query": query})
     return result.raw
 
+# Async variant so the MCP server's event loop is not blocked by a kickoff.
+# kickoff fills the query into the shared agents and tasks in place, so each
+# call runs on its own copy of the crew to keep overlapping requests apart
+async def run_financial_analysis_async(query):
+    result = await crew.copy().kickoff_async(inputs={"query": query})
+    return result.raw
+
 if __name__ == "__main__":
     # Run the crew with a query
     # query = input("Enter the stock to analyze: ")
@@ -36,8 +36,9 @@ async def run_agent(user_query: str):
             )
 
             # ④ 如果 LLM 决定调用工具
-            if llm_resp.choices[0].message.tool_calls:
-                call = llm_resp.choices[0].message.tool_calls[0]
+            message = llm_resp.choices[0].message
+            if message.tool_calls:
+                call = message.tool_calls[0]
                 tool_name = call.function.name
                 tool_args = json.loads(call.function.arguments)
 
@@ -46,14 +47,19 @@ async def run_agent(user_query: str):
                 print("工具返回：", result)
 
                 # ⑥ 把结果再喂给 LLM，生成自然语言答案
-                messages.append(llm_resp.choices[0].message)
+                messages.append(message)
                 messages.append({"role": "tool",
                                  "tool_call_id": call.id,
                                  "content": result.content})
-                final = await LLM.chat.completions.create(
-                    model="gpt-4o-mini", messages=messages
+                # 流式输出最终回答，首个 token 到达即可显示
+                stream = await LLM.chat.completions.create(
+                    model="gpt-4o-mini", messages=messages, stream=True
                 )
-                print("最终回答：", final.choices[0].message.content)
+                print("最终回答：", end="", flush=True)
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        print(chunk.choices[0].delta.content, end="", flush=True)
+                print()
 
 if __name__ == "__main__":
     asyncio.run(run_agent("请把当前目录的文件列出来，并读出 README.md 的前200字"))
\ No newline at end of file
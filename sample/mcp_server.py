@@ -1,11 +1,25 @@
+import os
 from mcp.server.fastmcp import FastMCP
-from finance_crew import run_financial_analysis
 
 # create FastMCP instance
 mcp = FastMCP("financial-analyst")
 
+# Compiled code of the last script run, keyed by (path, mtime_ns, size)
+_code_cache = {}
+
+def _load_code(path):
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    code = _code_cache.get(key)
+    if code is None:
+        with open(path, 'r') as f:
+            code = compile(f.read(), path, 'exec')
+        _code_cache.clear()
+        _code_cache[key] = code
+    return code
+
 @mcp.tool()
-def analyze_stock(query: str) -> str:
+async def analyze_stock(query: str) -> str:
     """
     Analyzes stock market data based on the query and generates executable Python code for analysis and visualization.
     Returns a formatted Python script ready for execution.
@@ -25,7 +39,10 @@ def analyze_stock(query: str) -> str:
         str: A nicely formatted python code as a string.
     """
     try:
-        result = run_financial_analysis(query)
+        # Imported lazily: finance_crew pulls in crewai/yfinance and builds the
+        # crew, which would otherwise delay the server handshake
+        from finance_crew import run_financial_analysis_async
+        result = await run_financial_analysis_async(query)
         return result
     except Exception as e:
         return f"Error: {e}"
@@ -44,8 +61,12 @@ def save_code(code: str) -> str:
         str: A message indicating the code was saved successfully.
     """
     try:
-        with open('stock_analysis.py', 'w') as f:
+        # Write to a temp file and swap it in, so a crash or a concurrent
+        # run_code_and_show_plot never sees a half-written script
+        with open('stock_analysis.py.tmp', 'w') as f:
             f.write(code)
+        os.replace('stock_analysis.py.tmp', 'stock_analysis.py')
+        _code_cache.clear()
         return "Code saved to stock_analysis.py"
     except Exception as e:
         return f"Error: {e}"
@@ -55,8 +76,7 @@ def run_code_and_show_plot() -> str:
     """
     Run the code in stock_analysis.py and generate the plot
     """
-    with open('stock_analysis.py', 'r') as f:
-        exec(f.read())
+    exec(_load_code('stock_analysis.py'))
 
 # Run the server locally
 if __name__ == "__main__":
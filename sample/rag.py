@@ -1,118 +1,272 @@
-from typing import List
-
-def split_into_chunks(doc_file: str) -> List[str]:
-    with open(doc_file, 'r') as file:
-        content = file.read()
-
-    return [chunk for chunk in content.split("\n\n")]
-
-chunks = split_into_chunks("doc.md")
-
-for i, chunk in enumerate(chunks):
-    print(f"[{i}] {chunk}\n")
-
-
-from sentence_transformers import SentenceTransformer
-from safetensors import safe_open
-
-embedding_model = SentenceTransformer("moka-ai/m3e-small") #"shibing624/text2vec-base-chinese")
-print(embedding_model)
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import mmap
+import os
+import re
+from typing import TYPE_CHECKING, Iterator, List
+
+if TYPE_CHECKING:
+    import chromadb
+    from openai import AsyncOpenAI
+    from sentence_transformers import CrossEncoder, SentenceTransformer
+
+# One or more blank lines, with LF or CRLF endings and whitespace-only lines
+CHUNK_SEPARATOR = re.compile(rb"\r?\n(?:[ \t]*\r?\n)+")
+
+def split_into_chunks(doc_file: str) -> Iterator[str]:
+    # Scan the mapped file for separators and decode one chunk at a time instead
+    # of holding the whole text plus a list of copies in memory. Empty chunks are
+    # dropped so they never reach the embedding model
+    with open(doc_file, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            for separator in CHUNK_SEPARATOR.finditer(mm):
+                if chunk := mm[start:separator.start()].decode('utf-8').strip():
+                    yield chunk
+                start = separator.end()
+            if chunk := mm[start:].decode('utf-8').strip():
+                yield chunk
+
+
+import numpy as np
+from safetensors.numpy import load_file, save_file
+
+QUANTIZED_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# Models and clients below are created on first use and then shared, and their
+# heavy libraries are only imported at that point
+
+def load_quantized_model(model_cls, model_name: str, save_dir: str):
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    # Export a dynamically int8-quantized ONNX copy once, then load that on later runs
+    if not os.path.exists(os.path.join(save_dir, QUANTIZED_ONNX_FILE)):
+        model = model_cls(model_name, backend="onnx")
+        model.save_pretrained(save_dir)
+        export_dynamic_quantized_onnx_model(model, "avx512_vnni", save_dir)
+    return model_cls(save_dir, backend="onnx", model_kwargs={"file_name": QUANTIZED_ONNX_FILE})
+
+EMBEDDING_MODEL_NAME = "moka-ai/m3e-small" #"shibing624/text2vec-base-chinese"
+
+embedding_model = None
+
+def get_embedding_model() -> SentenceTransformer:
+    global embedding_model
+    if embedding_model is None:
+        from sentence_transformers import SentenceTransformer
+        embedding_model = load_quantized_model(SentenceTransformer, EMBEDDING_MODEL_NAME, "m3e-small-onnx")
+    return embedding_model
 
 def embed_chunk(chunk: str) -> List[float]:
-    embedding = embedding_model.encode(chunk, normalize_embeddings=True)
+    embedding = get_embedding_model().encode(chunk, normalize_embeddings=True)
     return embedding.tolist()
 
-
-embedding = embed_chunk("测试内容")
-print(len(embedding))
-print(embedding)
-
-embeddings = [embed_chunk(chunk) for chunk in chunks]
-
-print(len(embeddings))
-print(embeddings[0])
-
-
-
-import chromadb
-
-chromadb_client = chromadb.EphemeralClient()
-chromadb_collection = chromadb_client.get_or_create_collection(name="default")
-
-def save_embeddings(chunks: List[str], embeddings: List[List[float]]) -> None:
-    for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-        chromadb_collection.add(
-            documents=[chunk],
-            embeddings=[embedding],
-            ids=[str(i)]
+@functools.lru_cache(maxsize=1024)
+def _embed_query_bytes(query: str) -> bytes:
+    return get_embedding_model().encode(query, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32).tobytes()
+
+def embed_query(query: str) -> np.ndarray:
+    # Repeated questions skip the transformer; cached as bytes so no caller can
+    # mutate a shared array (the returned view is read-only)
+    return np.frombuffer(_embed_query_bytes(query), dtype=np.float32)
+
+def embed_chunks(chunks: List[str]) -> np.ndarray:
+    # One batched encode call instead of one forward pass per chunk
+    return get_embedding_model().encode(chunks, batch_size=64, normalize_embeddings=True,
+                                        convert_to_numpy=True, show_progress_bar=False)
+
+def chunks_digest(chunks: List[str]) -> str:
+    # Embeddings only depend on the model and the chunk texts
+    digest = hashlib.sha256(f"{EMBEDDING_MODEL_NAME}:{QUANTIZED_ONNX_FILE}".encode())
+    for chunk in chunks:
+        digest.update(b"\0")
+        digest.update(chunk.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def load_or_embed_chunks(chunks: List[str]) -> np.ndarray:
+    # A re-run over the same document loads the saved matrix instead of re-encoding it
+    cache_file = f".emb_{chunks_digest(chunks)}.safetensors"
+
+    # Stored as fp16 to halve the file and the load. The rounding can reorder
+    # near-tied chunks, so fresh embeddings are rounded the same way and every run
+    # ranks identically. Searches upcast once, since numpy has no BLAS path for
+    # fp16 matmul
+    if os.path.exists(cache_file):
+        embeddings = load_file(cache_file)["embeddings"]
+    else:
+        embeddings = embed_chunks(chunks).astype(np.float16)
+        save_file({"embeddings": embeddings}, cache_file)
+    return embeddings.astype(np.float32)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # argpartition picks the k best in O(N); only those k are then sorted
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+# Below this many chunks a brute-force matmul beats Chroma's HNSW overhead
+CHROMA_MIN_CHUNKS = 10_000
+
+chromadb_client = None
+
+# Embeddings are L2-normalized, so use cosine; HNSW settings are fixed when a
+# collection is created, so they are given up front
+HNSW_METADATA = {"hnsw:space": "cosine", "hnsw:construction_ef": 200, "hnsw:M": 32, "hnsw:search_ef": 64}
+
+# Chroma caps the size of a single add(); stay well under it
+CHROMA_BATCH_SIZE = 1000
+
+def get_collection(chunks: List[str]) -> chromadb.Collection:
+    global chromadb_client
+    if chromadb_client is None:
+        import chromadb
+        chromadb_client = chromadb.PersistentClient(path=".chroma")
+    # One persisted collection per chunk set, so an edited document never reuses stale vectors
+    return chromadb_client.get_or_create_collection(name=f"chunks_{chunks_digest(chunks)}", metadata=HNSW_METADATA)
+
+def save_embeddings(collection: chromadb.Collection, chunks: List[str], embeddings: np.ndarray) -> None:
+    for start in range(0, len(chunks), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        # upsert, so re-running over a partially loaded collection fills in the gaps
+        collection.upsert(
+            documents=chunks[start:end],
+            embeddings=embeddings[start:end].tolist(),
+            ids=[str(i) for i in range(start, min(end, len(chunks)))]
         )
 
-save_embeddings(chunks, embeddings)
-
-def retrieve(query: str, top_k: int) -> List[str]:
-    query_embedding = embed_chunk(query)
-    results = chromadb_collection.query(
-        query_embeddings=[query_embedding],
+def retrieve(collection: chromadb.Collection, query: str, top_k: int) -> List[str]:
+    query_embedding = embed_query(query)
+    results = collection.query(
+        query_embeddings=[query_embedding.tolist()],
         n_results=top_k
     )
     return results['documents'][0]
 
-query = "哆啦A梦使用的3个秘密道具分别是什么？最终战斗发生在哪里,和谁?"
-retrieved_chunks = retrieve(query, 5)
+def retrieve_in_memory(emb_mat: np.ndarray, chunks: List[str], query: str, top_k: int) -> List[str]:
+    # Embeddings are L2-normalized, so cosine similarity is one matrix-vector product
+    sims = emb_mat @ embed_query(query)
+    return [chunks[i] for i in top_k_indices(sims, top_k)]
 
-for i, chunk in enumerate(retrieved_chunks):
-    print(f"[{i}] {chunk}\n")
+cross_encoder = None
 
-from sentence_transformers import CrossEncoder
+def get_cross_encoder() -> CrossEncoder:
+    global cross_encoder
+    if cross_encoder is None:
+        from sentence_transformers import CrossEncoder
+        cross_encoder = load_quantized_model(CrossEncoder, 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1', "mmarco-mMiniLMv2-onnx")
+    return cross_encoder
 
 def rerank(query: str, retrieved_chunks: List[str], top_k: int) -> List[str]:
-    cross_encoder = CrossEncoder('cross-encoder/mmarco-mMiniLMv2-L12-H384-v1')
     pairs = [(query, chunk) for chunk in retrieved_chunks]
-    scores = cross_encoder.predict(pairs)
-
-    scored_chunks = list(zip(retrieved_chunks, scores))
-    scored_chunks.sort(key=lambda x: x[1], reverse=True)
-
-    return [chunk for chunk, _ in scored_chunks][:top_k]
+    scores = get_cross_encoder().predict(pairs, batch_size=32, convert_to_numpy=True, show_progress_bar=False)
 
-reranked_chunks = rerank(query, retrieved_chunks, 3)
-
-for i, chunk in enumerate(reranked_chunks):
-    print(f"[{i}] {chunk}\n")
+    return [retrieved_chunks[i] for i in top_k_indices(np.asarray(scores), top_k)]
 
 from dotenv import load_dotenv
-from openai import OpenAI
 
 load_dotenv()
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key="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",
-)
+client = None
 
-def generate(query: str, chunks: List[str]) -> str:
-    prompt = f"""你是一位知识助手，请根据用户的问题和下列片段生成准确的回答。
+def get_client() -> AsyncOpenAI:
+    global client
+    if client is None:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(
+            base_url="https://openrouter.ai/api/v1",
+            api_key="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",
+        )
+    return client
 
-用户问题: {query}
+# Fixed instructions live in a constant system turn so every request shares a
+# byte-identical prefix the provider can cache; per-query data goes last
+SYSTEM_PROMPT = """你是一位知识助手，请根据用户的问题和提供的相关片段生成准确的回答。
+请只基于相关片段作答，不要编造信息。"""
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+USER_PROMPT_TEMPLATE = """用户问题: {query}
 
 相关片段:
-{"\n\n".join(chunks)}
+{context}"""
 
-请基于上述内容作答，不要编造信息。"""
+async def generate(query: str, chunks: List[str]) -> str:
+    prompt = USER_PROMPT_TEMPLATE.format_map({"query": query, "context": "\n\n".join(chunks)})
 
     print(f"{prompt}\n\n---\n")
 
-    response = client.chat.completions.create(
+    stream = await get_client().chat.completions.create(
         model="deepseek/deepseek-chat:free",
         messages=[
-            {"role": "system", "content": "你是一位知识助手"},
+            SYSTEM_MESSAGE,
             {"role": "user", "content": prompt}
         ],
         temperature=0.5,
-        max_tokens=10240
+        max_tokens=10240,
+        stream=True
     )
 
-    return response.choices[0].message.content
+    # Print tokens as they arrive instead of waiting for the whole answer
+    parts = []
+    async for event in stream:
+        if event.choices and (delta := event.choices[0].delta.content):
+            parts.append(delta)
+            print(delta, end="", flush=True)
+    print()
+
+    return "".join(parts)
+
+async def main():
+    # The reranker is only needed after retrieval, so load it in the background
+    # while the embedding model loads and the chunks are embedded, stored and searched
+    cross_encoder_task = asyncio.create_task(asyncio.to_thread(get_cross_encoder))
+
+    # Model work runs in worker threads so the event loop stays free
+    embedding_model = await asyncio.to_thread(get_embedding_model)
+
+    chunks = list(split_into_chunks("doc.md"))
+
+    for i, chunk in enumerate(chunks):
+        print(f"[{i}] {chunk}\n")
+
+    print(embedding_model)
+
+    embedding = await asyncio.to_thread(embed_chunk, "测试内容")
+    print(len(embedding))
+    print(embedding)
+
+    embeddings = await asyncio.to_thread(load_or_embed_chunks, chunks)
+
+    print(len(embeddings))
+    print(embeddings[0])
+
+    if len(chunks) > CHROMA_MIN_CHUNKS:
+        collection = get_collection(chunks)
+        if collection.count() != len(chunks):
+            save_embeddings(collection, chunks, embeddings)
+        search = functools.partial(retrieve, collection)
+    else:
+        search = functools.partial(retrieve_in_memory, np.asarray(embeddings, dtype=np.float32), chunks)
+
+    query = "哆啦A梦使用的3个秘密道具分别是什么？最终战斗发生在哪里,和谁?"
+    retrieved_chunks = await asyncio.to_thread(search, query, 5)
+
+    for i, chunk in enumerate(retrieved_chunks):
+        print(f"[{i}] {chunk}\n")
+
+    await cross_encoder_task
+    reranked_chunks = await asyncio.to_thread(rerank, query, retrieved_chunks, 3)
+
+    for i, chunk in enumerate(reranked_chunks):
+        print(f"[{i}] {chunk}\n")
+
+    await generate(query, reranked_chunks)
 
-answer = generate(query, reranked_chunks)
-print(answer)
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())